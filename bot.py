@@ -1,12 +1,83 @@
 # bot.py
-import os, requests, math
-from datetime import datetime
+import os, math, json, time, glob, hashlib, gzip, zlib
+from datetime import datetime, timedelta, timezone
+from http.client import HTTPSConnection, HTTPException
+from urllib.parse import urlsplit
+
+try:
+    from orjson import loads as json_loads  # ~3x faster on amedastable.json
+except ImportError:
+    json_loads = json.loads
 
 # ---- JMA endpoints (official) ----
 JMA_TABLE = "https://www.jma.go.jp/bosai/amedas/const/amedastable.json"        # station metadata
 JMA_LATEST_TIME = "https://www.jma.go.jp/bosai/amedas/data/latest_time.txt"    # ISO8601 JST
 JMA_SELECTOR = "https://www.jma.go.jp/bosai/const/selectorinfos/amedas.json"   # element name map
 
+JST = timezone(timedelta(hours=9))  # no DST, so a fixed offset is exact
+
+# ---- Local cache (metadata rarely changes; avoid re-downloading every run) ----
+CACHE_DIR = os.path.expanduser(os.getenv("JMA_CACHE_DIR", "~/.cache/jma"))
+TABLE_TTL = 7 * 24 * 3600      # amedastable.json
+POINT_TTL = 300                # point/*.json (observations update every 10 min)
+LATEST_TIME_TTL = 60           # latest_time.txt
+
+# ---- Minimal stdlib HTTP client (keep-alive: one TLS connection per host) ----
+HTTP_HEADERS = {"User-Agent": "jma-amedas-bot/1.0", "Accept-Encoding": "gzip, deflate"}
+HTTP_TIMEOUT = 20
+HTTP_RETRIES = 3
+RETRY_STATUS = (502, 503, 504)
+_CONNS = {}
+
+class HTTPError(OSError):
+    def __init__(self, what, status):
+        super().__init__(f"{what}: HTTP {status}")
+        self.status = status
+
+def _decode_body(data, encoding):
+    encoding = (encoding or "").strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+        return gzip.decompress(data)
+    if encoding == "deflate":
+        try:
+            return zlib.decompress(data)
+        except zlib.error:  # some servers send raw deflate without the zlib header
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    return data
+
+def _request(method, url, body=None, headers=None):
+    """Send one request over the pooled connection; returns (status, headers, body bytes)."""
+    u = urlsplit(url)
+    path = u.path + (f"?{u.query}" if u.query else "")
+    conn = _CONNS.get(u.netloc)
+    if conn is None:
+        conn = _CONNS[u.netloc] = HTTPSConnection(u.netloc, timeout=HTTP_TIMEOUT)
+    try:
+        conn.request(method, path, body=body, headers={**HTTP_HEADERS, **(headers or {})})
+        r = conn.getresponse()
+        data = r.read()
+    except (OSError, HTTPException):
+        conn.close()  # stale keep-alive or network error; reconnect next time
+        del _CONNS[u.netloc]
+        raise
+    data = _decode_body(data, r.getheader("Content-Encoding"))
+    return r.status, r.headers, data
+
+def _get(url, headers=None):
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            status, h, data = _request("GET", url, headers=headers)
+            if status not in RETRY_STATUS or attempt == HTTP_RETRIES:
+                return status, h, data
+        except (OSError, HTTPException):
+            if attempt == HTTP_RETRIES:
+                raise
+        time.sleep(0.3 * 2**attempt)
+
+def _post_json(url, obj, headers=None):
+    return _request("POST", url, body=json.dumps(obj).encode("utf-8"),
+                    headers={"Content-Type": "application/json", **(headers or {})})
+
 # ---- Notifiers ----
 SLACK_WEBHOOK = os.getenv("SLACK_WEBHOOK_URL")              # optional
 LINE_TOKEN     = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")     # optional
@@ -15,42 +86,236 @@ LINE_TOKEN     = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")     # optional
 LAT = float(os.getenv("LAT", "34.8663494"))
 LON = float(os.getenv("LON", "137.1739931"))
 
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371000.0
-    p1, p2 = math.radians(lat1), math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlmb = math.radians(lon2 - lon1)
-    a = math.sin(dphi/2)**2 + math.cos(p1)*math.cos(p2)*math.sin(dlmb/2)**2
-    return 2 * R * math.atan2(a**0.5, (1 - a)**0.5)
+def _write_json(path, obj):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def _cached_get(url, cache_path, ttl):
+    """GET with an on-disk cache: fresh within ttl, else revalidate via ETag/Last-Modified."""
+    try:
+        with open(cache_path, "rb") as f:
+            entry = json_loads(f.read())
+    except (OSError, ValueError):
+        entry = None
+    now = time.time()
+    if entry and now - entry.get("fetched", 0) < ttl:
+        return entry
+
+    headers = {}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    status, h, data = _get(url, headers)
+    if entry and status == 304:
+        entry["fetched"] = now
+    else:
+        if status != 200:
+            raise HTTPError(f"GET {url}", status)
+        entry = {
+            "etag": h.get("ETag"),
+            "last_modified": h.get("Last-Modified"),
+            "fetched": now,
+            "body": data.decode("utf-8"),
+        }
+    try:
+        _write_json(cache_path, entry)
+    except OSError:
+        pass  # cache is best-effort
+    return entry
+
+def cached_get_json(url, cache_path, ttl):
+    return json_loads(_cached_get(url, cache_path, ttl)["body"])
+
+def cached_get_text(url, cache_path, ttl):
+    return _cached_get(url, cache_path, ttl)["body"]
+
+def purge_point_cache(max_age=24 * 3600):
+    cutoff = time.time() - max_age
+    for path in glob.glob(os.path.join(CACHE_DIR, "point_*.json")):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+EARTH_R = 6371000.0
+NPZ_SCHEMA = 3   # bump when the .npz layout changes
+NPZ_PATH = os.path.join(CACHE_DIR, "amedastable.npz")
+VERSION_PATH = os.path.join(CACHE_DIR, "amedastable.version")  # sidecar: lets memo hits skip numpy
+
+# numpy is imported inside the station functions so warm runs (memo hit) never load it
+
+def unit_xyz(lat, lon):
+    """Unit vector(s) on the sphere for lat/lon in degrees (scalars or arrays)."""
+    import numpy as np
+    p, l = np.radians(lat), np.radians(lon)
+    return np.stack([np.cos(p)*np.cos(l), np.cos(p)*np.sin(l), np.sin(p)], axis=-1)
+
+def central_angle(a, b):
+    """Vincenty form atan2(|a x b|, a . b); stable at all separations."""
+    import numpy as np
+    return math.atan2(float(np.linalg.norm(np.cross(a, b))), float(np.dot(a, b)))
+
+def load_station_arrays():
+    """Station table (plus its ETag as "version"), cached as .npz.
+
+    Only the scan array xyz is float32 (struct-of-arrays, ~15 KB); lats/lons stay
+    float64 so reported coordinates and distances are exact.
+    """
+    import numpy as np
+    npz_path = NPZ_PATH
+    try:
+        mtime = os.path.getmtime(npz_path)
+        if time.time() - mtime < TABLE_TTL:
+            with np.load(npz_path) as z:
+                if "schema" in z.files and int(z["schema"]) == NPZ_SCHEMA:
+                    arrs = {k: z[k] for k in z.files}
+                    if not os.path.exists(VERSION_PATH):
+                        _write_version(str(arrs["version"]), mtime)
+                    return arrs
+    except (OSError, ValueError):
+        pass
+
+    entry = _cached_get(JMA_TABLE, os.path.join(CACHE_DIR, "amedastable.json"), TABLE_TTL)
+    meta = json_loads(entry["body"])
+    lats = np.array([v["lat"][0] + v["lat"][1]/60 for v in meta.values()])
+    lons = np.array([v["lon"][0] + v["lon"][1]/60 for v in meta.values()])
+    arrs = {
+        "schema": np.array(NPZ_SCHEMA),
+        "version": np.array(entry.get("etag") or hashlib.sha1(entry["body"].encode()).hexdigest()),
+        "sids": np.array(list(meta.keys())),
+        "names": np.array([v.get("kjName", "") for v in meta.values()]),
+        "lats": lats,
+        "lons": lons,
+        "xyz": np.ascontiguousarray(unit_xyz(lats, lons).T, dtype=np.float32),  # (3, N)
+    }
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = f"{npz_path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrs)
+        os.replace(tmp, npz_path)
+        _write_version(str(arrs["version"]), os.path.getmtime(npz_path))
+    except OSError:
+        pass
+    return arrs
+
+def _write_version(version, mtime):
+    """Sidecar with the .npz's table version; shares its mtime so both expire together."""
+    try:
+        with open(VERSION_PATH, "w", encoding="utf-8") as f:
+            f.write(version)
+        os.utime(VERSION_PATH, (mtime, mtime))
+    except OSError:
+        pass
+
+def _table_version():
+    try:
+        if time.time() - os.path.getmtime(VERSION_PATH) < TABLE_TTL:
+            with open(VERSION_PATH, encoding="utf-8") as f:
+                return f.read().strip() or None
+    except OSError:
+        pass
+    return None
+
+def _read_memo(path):
+    try:
+        with open(path, "rb") as f:
+            return json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def _nearest_memo_path(lat, lon, version):
+    # memoized per (lat, lon, table version); a new ETag yields a new key
+    key = hashlib.sha1(f"{lat:.6f},{lon:.6f},{version},{NPZ_SCHEMA}".encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"nearest_{key}.json")
 
 def nearest_amedas(lat, lon):
-    meta = requests.get(JMA_TABLE, timeout=20).json()
-    best = None
-    for sid, v in meta.items():
-        plat = v["lat"][0] + v["lat"][1]/60
-        plon = v["lon"][0] + v["lon"][1]/60
-        d = haversine(lat, lon, plat, plon)
-        if not best or d < best[0]:
-            best = (d, sid, v.get("kjName", ""), plat, plon)
-    return {"station_id": best[1], "name": best[2], "lat": best[3], "lon": best[4], "dist_m": round(best[0])}
+    # warm path: sidecar version + memo file, no numpy or .npz needed
+    version = _table_version()
+    best = _read_memo(_nearest_memo_path(lat, lon, version)) if version else None
+    if best is not None:
+        return best
 
-def latest_point_json(station_id):
-    ttxt = requests.get(JMA_LATEST_TIME, timeout=20).text.strip()
-    dt = datetime.fromisoformat(ttxt)  # JST
+    import numpy as np
+    st = load_station_arrays()
+    memo_path = _nearest_memo_path(lat, lon, str(st["version"]))
+    if str(st["version"]) != version:  # sidecar was missing/stale
+        best = _read_memo(memo_path)
+        if best is not None:
+            return best
+
+    # nearest on the sphere == shortest chord between unit vectors; unlike the
+    # dot product (cos ~ 1), the chord keeps metre-level precision in float32
+    q = unit_xyz(lat, lon)
+    qx, qy, qz = q.astype(np.float32)
+    x, y, z = st["xyz"]
+    i = int(np.argmin((x - qx)**2 + (y - qy)**2 + (z - qz)**2))
+    d = EARTH_R * central_angle(unit_xyz(float(st["lats"][i]), float(st["lons"][i])), q)
+    best = {"station_id": str(st["sids"][i]), "name": str(st["names"][i]),
+            "lat": float(st["lats"][i]), "lon": float(st["lons"][i]), "dist_m": round(d)}
+    try:
+        _write_json(memo_path, best)
+    except OSError:
+        pass
+    return best
+
+def _point_json(station_id, dt):
     ymd = dt.strftime("%Y%m%d")
     h3 = f"{(dt.hour//3)*3:02d}"
     url = f"https://www.jma.go.jp/bosai/amedas/data/point/{station_id}/{ymd}_{h3}.json"
-    js = requests.get(url, timeout=20).json()
-    k = max(js.keys())
+    return cached_get_json(url, os.path.join(CACHE_DIR, f"point_{station_id}_{ymd}_{h3}.json"), POINT_TTL)
+
+def latest_point_json(station_id):
+    purge_point_cache()
+    # point files are 3-hour JST buckets, so the current one follows from the clock;
+    # just past a boundary it may not exist yet, then ask latest_time.txt
+    try:
+        js = _point_json(station_id, datetime.now(JST))
+    except HTTPError as e:
+        if e.status != 404:
+            raise
+        js = None
+    if not js:
+        ttxt = cached_get_text(JMA_LATEST_TIME, os.path.join(CACHE_DIR, "latest_time.txt.json"), LATEST_TIME_TTL).strip()
+        js = _point_json(station_id, datetime.fromisoformat(ttxt))  # JST
+    if not js:
+        raise ValueError(f"no observations for station {station_id}")
+    k = next(reversed(js))  # assumes JMA emits keys in ascending time order (it does)
     return k, js[k]
 
-# --- robust element label loader (dict/list both OK) ---
-def load_elem_labels():
+# --- element labels: static map, optionally refreshed from selectorinfos ---
+STATIC_ELEM_LABELS = {
+    "temp": "気温",
+    "humidity": "湿度",
+    "wind": "風速",
+    "windDirection": "風向",
+    "gust": "最大瞬間風速",
+    "gustDirection": "最大瞬間風向",
+    "precipitation10m": "10分間降水量",
+    "precipitation1h": "1時間降水量",
+    "precipitation3h": "3時間降水量",
+    "precipitation24h": "24時間降水量",
+    "sunshine10m": "10分間日照時間",
+    "snowDepth": "積雪深",
+    "pressure": "現地気圧",
+    "seaLevelPressure": "海面気圧",
+    "visibility": "視程",
+}
+ELEM_LABELS_PATH = os.path.join(CACHE_DIR, "elem_labels.json")
+
+def fetch_elem_labels():
+    """Labels from selectorinfos (dict/list both OK); None if it can't be fetched or parsed."""
     mapping = {}
     try:
-        sel = requests.get(JMA_SELECTOR, timeout=20).json()
-    except Exception:
-        sel = None
+        sel = cached_get_json(JMA_SELECTOR, os.path.join(CACHE_DIR, "selectorinfos_amedas.json"), 0)
+    except Exception as e:
+        print("selectorinfos fetch failed:", e)
+        return None
 
     if isinstance(sel, dict) and "selectors" in sel:
         blocks = sel["selectors"]
@@ -69,25 +334,39 @@ def load_elem_labels():
                 name = item.get("name") or item.get("ja") or val
                 if val:
                     mapping[val] = name
+    if not mapping:
+        print("selectorinfos: no element labels found")
+        return None
 
     # fallbacks
-    mapping.setdefault("temp", "気温")
-    mapping.setdefault("humidity", "湿度")
-    mapping.setdefault("wind", "風速")
-    mapping.setdefault("windDirection", "風向")
-    mapping.setdefault("gust", "最大瞬間風速")
-    mapping.setdefault("gustDirection", "最大瞬間風向")
-    mapping.setdefault("precipitation10m", "10分間降水量")
-    mapping.setdefault("precipitation1h", "1時間降水量")
-    mapping.setdefault("precipitation3h", "3時間降水量")
-    mapping.setdefault("precipitation24h", "24時間降水量")
-    mapping.setdefault("sunshine10m", "10分間日照時間")
-    mapping.setdefault("snowDepth", "積雪深")
-    mapping.setdefault("pressure", "現地気圧")
-    mapping.setdefault("seaLevelPressure", "海面気圧")
-    mapping.setdefault("visibility", "視程")
+    for k, v in STATIC_ELEM_LABELS.items():
+        mapping.setdefault(k, v)
     return mapping
 
+def load_elem_labels(keys=None):
+    """Static labels; REFRESH_LABELS=1 re-fetches selectorinfos into elem_labels.json.
+
+    If `keys` (the elements actually present) are all covered by the static map,
+    it is returned without touching disk or network.
+    """
+    refresh = os.getenv("REFRESH_LABELS") == "1"
+    if keys is not None and not refresh and all(k in STATIC_ELEM_LABELS for k in keys):
+        return STATIC_ELEM_LABELS
+    if refresh:
+        mapping = fetch_elem_labels()
+        if mapping is not None:
+            try:
+                _write_json(ELEM_LABELS_PATH, mapping)
+            except OSError:
+                pass
+            return mapping
+        # refresh failed: keep the previously refreshed file, if any
+    try:
+        with open(ELEM_LABELS_PATH, "rb") as f:
+            return json_loads(f.read())
+    except (OSError, ValueError):
+        return STATIC_ELEM_LABELS
+
 def flatten_values(row: dict):
     def take(v):
         if v is None: return None
@@ -104,29 +383,58 @@ def dir16_name(code):
     except Exception:
         return str(code)
 
+UNITS = {
+    "temp": "℃",
+    "humidity": "%",
+    "wind": "m/s",
+    "gust": "m/s",
+    "windDirection": "",           # 方向は方位名に変換するので単位なし
+    "gustDirection": "",
+    "precipitation10m": "mm/10m",
+    "precipitation1h": "mm/h",
+    "precipitation3h": "mm/3h",
+    "precipitation24h": "mm",
+    "snowDepth": "cm",
+    "sunshine10m": "min/10m",
+    "pressure": "hPa",
+    "seaLevelPressure": "hPa",
+    "visibility": "km",
+}
+
 def fmt_unit(key):
-    units = {
-        "temp": "℃",
-        "humidity": "%",
-        "wind": "m/s",
-        "gust": "m/s",
-        "windDirection": "",           # 方向は方位名に変換するので単位なし
-        "gustDirection": "",
-        "precipitation10m": "mm/10m",
-        "precipitation1h": "mm/h",
-        "precipitation3h": "mm/3h",
-        "precipitation24h": "mm",
-        "snowDepth": "cm",
-        "sunshine10m": "min/10m",
-        "pressure": "hPa",
-        "seaLevelPressure": "hPa",
-        "visibility": "km",
-    }
-    return units.get(key, "")
+    return UNITS.get(key, "")
+
+# --- 表示順（気温・湿度・風…）; 未知の要素は末尾にキー順で ---
+PREFERRED_ORDER = ("temp", "humidity", "wind", "windDirection", "gust", "gustDirection",
+                   "pressure", "seaLevelPressure", "precipitation10m", "precipitation1h",
+                   "precipitation3h", "precipitation24h", "sunshine10m", "snowDepth", "visibility")
+_PREFERRED = frozenset(PREFERRED_ORDER)
+
+def ordered_keys(vals):
+    """Keys of vals with a value, in display order."""
+    keys = [k for k in PREFERRED_ORDER if vals.get(k) is not None]
+    keys.extend(sorted(k for k, v in vals.items() if v is not None and k not in _PREFERRED))
+    return keys
+
+# --- 1行テンプレート（静的ラベルから起動時に組み立て）---
+LINE_FMT = {k: "- " + STATIC_ELEM_LABELS[k] + ": {}" + UNITS[k] for k in PREFERRED_ORDER}
+DIR_KEYS = frozenset(("windDirection", "gustDirection"))
+
+def format_lines(vals, labels=STATIC_ELEM_LABELS):
+    """Message lines "- 名前: 値単位" in display order; directions as 16-point names."""
+    fmt = LINE_FMT if labels is STATIC_ELEM_LABELS else {}
+    lines = []
+    for k in ordered_keys(vals):
+        v = dir16_name(vals[k]) if k in DIR_KEYS else vals[k]
+        f = fmt.get(k)
+        lines.append(f.format(v) if f else f"- {labels.get(k, k)}: {v}{fmt_unit(k)}")
+    return lines
 
 def notify_slack(text):
     if not SLACK_WEBHOOK: 
         print("Slack webhook not set; skip"); 
         return
-    r = requests.post(SLACK_WEBHOOK, json={"text": text}, timeout=20)
-    print("Slack POST:", r.status_code, (r.text or "")[:200])
+    status, _, data = _post_json(SLACK_WEBHOOK, {"text": text})
+    print("Slack POST:", status, data.decode("utf-8", "replace")[:200])
+    if status != 200:
+        raise HTTPError("Slack POST", status)